@@ -1,22 +1,62 @@
+import io
 import os
 import time
-import json
+import asyncio
+import hashlib
 import logging
-from flask import Flask, render_template, request, jsonify
+import orjson
+import redis.asyncio as redis
+from quart import Quart, render_template, request, jsonify, make_response
+from quart.json.provider import DefaultJSONProvider
 from pydantic import BaseModel, Field
-from typing import List
+from typing import IO, Callable, List, Optional
+from collections import Counter, OrderedDict
 from google import genai
 
-app = Flask(__name__)
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = 500 * 1024 * 1024
+# 表单解析受 BODY_TIMEOUT 限制 (默认 60s); 30 分钟约等于 500 MB @ 2.3 Mbit/s
+app.config["BODY_TIMEOUT"] = 30 * 60
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
 DEFAULT_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+# File API 轮询: 指数退避 0.25s -> 5s, 总超时 600s
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 5.0
+POLL_TIMEOUT = 600
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# 按 API key 复用 genai.Client (保留 TLS / HTTP 连接), LRU 上限
+MAX_CLIENTS = 32
+_CLIENTS: "OrderedDict[str, genai.Client]" = OrderedDict()
+# 正在使用各 client 的请求数; 被 LRU 淘汰的 client 等空闲后再关闭
+_CLIENT_USERS: "Counter[genai.Client]" = Counter()
+
+# 后台清理任务的强引用, 防止 task 被 GC
+_BACKGROUND_TASKS = set()
+
+# 分析结果缓存: key = 视频 SHA-256 + persona + model + schema 版本
+REDIS_URL = os.environ.get("REDIS_URL")
+CACHE_TTL = 86400
+CACHE_SCHEMA_VERSION = "v3"
+HASH_CHUNK_SIZE = 1 << 20
+cache = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# 正在进行的分析: cache key -> Future, 相同视频并发请求只跑一次 Gemini
+_INFLIGHT = {}
+
 # ========== Pydantic 模型 (保持不变) ==========
 
 class SideAnalysis(BaseModel):
@@ -28,76 +68,182 @@ class SideAnalysis(BaseModel):
     coach_feedback: str = Field(description="Specific feedback on execution, style depends on the requested persona.")
     details: str = Field(description="A strict Markdown bulleted list (starting with '*') detailing the chronological events. NO paragraphs.")
 
-class FullPlayAnalysis(BaseModel):
-    offense: SideAnalysis = Field(description="Analysis for the Offense.")
-    defense: SideAnalysis = Field(description="Analysis for the Defense.")
+# ========== Prompt (启动时构建一次) ==========
+
+# --- Persona 指令 ---
+PERSONA_INSTRUCTIONS = {
+    "belichick": (
+        "For 'coach_feedback', adopt the persona of BILL BELICHICK. "
+        "Style: Grumpy, short sentences, brutally honest, obsessed with details. "
+        "Focus on mistakes and situational awareness."
+    ),
+    "dungy": (
+        "For 'coach_feedback', adopt the persona of TONY DUNGY. "
+        "Style: Calm, soft-spoken, mentor-like, focused on fundamentals. "
+        "Be constructive but firm."
+    ),
+    "regular": (
+        "For 'coach_feedback', provide standard, professional coaching advice."
+    ),
+}
+
+# --- 核心修改：强制 details 使用 Bullet Points ---
+def build_prompt(side: str, persona_instruction: str) -> str:
+    return (
+        "You are an expert American Football coach analyzing game film. "
+        f"Analyze the attached video clip for the {side.upper()} only.\n\n"
+        f"{persona_instruction}\n\n"
+        "Identify the Formation, Personnel, Key Players, and Play Concept.\n"
+        "CRITICAL FORMATTING RULE: The 'details' field MUST be a Markdown bulleted list. "
+        "Use an asterisk (*) for every single point. DO NOT write in paragraphs or blocks of text.\n" # <--- 加强语气
+        "Example format:\n"
+        "* Pre-snap read: [Observation]\n"
+        "* Snap to handoff: [Action]\n"
+        "* Key block: [Action]\n"
+        "* Result: [Outcome]"
+    )
+
+# 进攻/防守分成两个较小的请求并行生成
+SIDES = ("offense", "defense")
+
+PROMPT_BY_PERSONA = {
+    name: {side: build_prompt(side, text) for side in SIDES}
+    for name, text in PERSONA_INSTRUCTIONS.items()
+}
+
+GENERATE_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": SideAnalysis,
+}
 
 # ========== Gemini 函数 ==========
 
-def upload_and_process_video(local_path: str, client: genai.Client):
-    logger.info(f"Uploading video: {local_path}")
-    video_file = client.files.upload(file=local_path)
-    while video_file.state.name == "PROCESSING":
-        time.sleep(2)
-        video_file = client.files.get(name=video_file.name)
-    if video_file.state.name != "ACTIVE":
-        raise RuntimeError(f"Video processing failed: {video_file.state.name}")
+def get_client(api_key: str) -> genai.Client:
+    # 单线程事件循环内调用, 无 await, 不需要锁; 用完必须 release_client
+    client = _CLIENTS.get(api_key)
+    if client is None:
+        client = genai.Client(api_key=api_key)
+        _CLIENTS[api_key] = client
+        if len(_CLIENTS) > MAX_CLIENTS:
+            _, evicted = _CLIENTS.popitem(last=False)
+            if evicted not in _CLIENT_USERS:
+                spawn_background(close_client(evicted))
+    else:
+        _CLIENTS.move_to_end(api_key)
+    _CLIENT_USERS[client] += 1
+    return client
+
+def release_client(client: genai.Client):
+    _CLIENT_USERS[client] -= 1
+    if _CLIENT_USERS[client] <= 0:
+        del _CLIENT_USERS[client]
+        if client not in _CLIENTS.values():
+            spawn_background(close_client(client))
+
+async def close_client(client: genai.Client):
+    # 关闭同步 / 异步两套 HTTP 连接池 (旧版 SDK 可能没有这些方法)
+    try:
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+        aio = getattr(client, "aio", None)
+        if aio is not None and hasattr(aio, "aclose"):
+            await aio.aclose()
+    except Exception as e:
+        logger.warning(f"Gemini client close failed: {e}")
+
+class ThreadedAsyncClient:
+    # 旧版 SDK 没有 client.aio 时的兜底: 同步调用放进线程, 不阻塞事件循环
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return ThreadedAsyncClient(attr)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
+
+def async_api(client: genai.Client):
+    aio = getattr(client, "aio", None)
+    return aio if aio is not None else ThreadedAsyncClient(client)
+
+async def delete_gemini_file(client: genai.Client, name: str):
+    try:
+        await async_api(client).files.delete(name=name)
+    except Exception as e:
+        logger.warning(f"Gemini file delete failed: {e}")
+    finally:
+        release_client(client)
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+def schedule_cleanup(client: genai.Client, name: str):
+    # 删除远端文件不阻塞响应, 删除完成后释放 client
+    spawn_background(delete_gemini_file(client, name))
+
+# 进度回调: notify(event, data), 用于 SSE 推送状态
+Notify = Callable[[str, Optional[dict]], None]
+
+def _no_notify(event: str, data: Optional[dict] = None):
+    pass
+
+async def upload_and_process_video(stream: IO[bytes], mime_type: str, client: genai.Client, notify: Notify = _no_notify):
+    # 直接把请求里的文件流交给 File API, 不再先落盘再读回
+    logger.info(f"Uploading video ({mime_type})")
+    notify("upload", None)
+    # aio 上传对 IOBase 会在事件循环里同步 read(), 所以上传走同步 client + 线程
+    video_file = await ThreadedAsyncClient(client).files.upload(file=stream, config={"mime_type": mime_type})
+    state = video_file.state.name
+    # 小视频上传后通常已是 ACTIVE, 直接返回
+    if state == "ACTIVE":
+        return video_file
+    delay = POLL_INITIAL_DELAY
+    start = time.monotonic()
+    while state == "PROCESSING":
+        notify("processing", {"elapsed": round(time.monotonic() - start, 1)})
+        if time.monotonic() - start > POLL_TIMEOUT:
+            raise RuntimeError(f"Video processing timed out after {POLL_TIMEOUT}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        video_file = await async_api(client).files.get(name=video_file.name)
+        state = video_file.state.name
+    if state != "ACTIVE":
+        raise RuntimeError(f"Video processing failed: {state}")
     return video_file
 
-def call_gemini_with_video(video_path: str, api_key: str, persona: str) -> dict:
+async def generate_side(client: genai.Client, video_file, prompt: str) -> dict:
+    response = await async_api(client).models.generate_content(
+        model=GEMINI_MODEL,
+        contents=[video_file, prompt],
+        config=GENERATE_CONFIG,
+    )
+
+    if getattr(response, "parsed", None):
+        return response.parsed.model_dump()
+    else:
+        return orjson.loads(response.text)
+
+async def call_gemini_with_video(stream: IO[bytes], mime_type: str, api_key: str, persona: str, notify: Notify = _no_notify) -> dict:
     video_file = None
     client = None
     try:
-        client = genai.Client(api_key=api_key)
-        video_file = upload_and_process_video(video_path, client)
-
-        # --- Persona 指令 ---
-        persona_instruction = ""
-        if persona == "belichick":
-            persona_instruction = (
-                "For 'coach_feedback', adopt the persona of BILL BELICHICK. "
-                "Style: Grumpy, short sentences, brutally honest, obsessed with details. "
-                "Focus on mistakes and situational awareness."
-            )
-        elif persona == "dungy":
-            persona_instruction = (
-                "For 'coach_feedback', adopt the persona of TONY DUNGY. "
-                "Style: Calm, soft-spoken, mentor-like, focused on fundamentals. "
-                "Be constructive but firm."
-            )
-        else: # regular
-            persona_instruction = (
-                "For 'coach_feedback', provide standard, professional coaching advice."
-            )
-
-        # --- 核心修改：强制 details 使用 Bullet Points ---
-        prompt = (
-            "You are an expert American Football coach analyzing game film. "
-            "Analyze the attached video clip for BOTH Offense and Defense.\n\n"
-            f"{persona_instruction}\n\n"
-            "Identify the Formation, Personnel, Key Players, and Play Concept.\n"
-            "CRITICAL FORMATTING RULE: The 'details' field MUST be a Markdown bulleted list. "
-            "Use an asterisk (*) for every single point. DO NOT write in paragraphs or blocks of text.\n" # <--- 加强语气
-            "Example format:\n"
-            "* Pre-snap read: [Observation]\n"
-            "* Snap to handoff: [Action]\n"
-            "* Key block: [Action]\n"
-            "* Result: [Outcome]"
-        )
+        client = get_client(api_key)
+        video_file = await upload_and_process_video(stream, mime_type, client, notify)
+        notify("generating", None)
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[video_file, prompt],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": FullPlayAnalysis,
-            },
-        )
+        prompts = PROMPT_BY_PERSONA.get(persona, PROMPT_BY_PERSONA["regular"])
 
-        if getattr(response, "parsed", None):
-            return response.parsed.model_dump()
-        else:
-            return json.loads(response.text)
+        results = await asyncio.gather(
+            *(generate_side(client, video_file, prompts[side]) for side in SIDES)
+        )
+        return dict(zip(SIDES, results))
 
     except Exception as e:
         logger.error(f"Gemini API Error: {e}")
@@ -105,40 +251,177 @@ def call_gemini_with_video(video_path: str, api_key: str, persona: str) -> dict:
     
     finally:
         if client and video_file:
-            try:
-                client.files.delete(name=video_file.name)
-            except:
-                pass
-        if os.path.exists(video_path):
-            os.remove(video_path)
+            schedule_cleanup(client, video_file.name)
+        elif client:
+            release_client(client)
+
+# ========== 缓存 ==========
 
-# ========== Flask 路由 ==========
+def stream_digest(stream: IO[bytes]) -> str:
+    h = hashlib.sha256()
+    while chunk := stream.read(HASH_CHUNK_SIZE):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+def cache_key(digest: str, persona: str) -> str:
+    return f"analysis:{digest}:{persona}:{GEMINI_MODEL}:{CACHE_SCHEMA_VERSION}"
+
+async def cache_get(key: str):
+    if cache is None:
+        return None
+    try:
+        cached = await cache.get(key)
+    except redis.RedisError as e:
+        logger.warning(f"Cache read failed: {e}")
+        return None
+    return orjson.loads(cached) if cached else None
+
+async def cache_set(key: str, result: dict):
+    if cache is None:
+        return
+    try:
+        await cache.set(key, orjson.dumps(result), ex=CACHE_TTL)
+    except redis.RedisError as e:
+        logger.warning(f"Cache write failed: {e}")
+
+async def analyze_and_cache(key: str, stream: IO[bytes], mime_type: str, api_key: str, persona: str, notify: Notify = _no_notify) -> dict:
+    result = await call_gemini_with_video(stream, mime_type, api_key, persona, notify)
+    if "error" not in result:
+        await cache_set(key, result)
+    return result
+
+async def analyze_once(key: str, stream: IO[bytes], mime_type: str, api_key: str, persona: str, notify: Notify = _no_notify) -> dict:
+    fut = _INFLIGHT.get(key)
+    if fut is not None:
+        logger.info(f"Joining in-flight analysis: {key}")
+        notify("joined", None)
+        try:
+            result = await asyncio.shield(fut)
+            if "error" not in result:
+                return result
+        except Exception:
+            pass
+        # 只共享成功结果: 失败可能来自对方的 API key (无效 / 超额), 用自己的 key 重跑
+        logger.info(f"In-flight analysis failed, running own analysis: {key}")
+        return await analyze_and_cache(key, stream, mime_type, api_key, persona, notify)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        result = await analyze_and_cache(key, stream, mime_type, api_key, persona, notify)
+        fut.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # owner 被取消时, 等待者拿到普通异常而不是 CancelledError
+        fut.set_exception(RuntimeError("Analysis was cancelled"))
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        _INFLIGHT.pop(key, None)
+        # 没有等待者时标记异常已读取, 避免 "exception was never retrieved" 日志
+        if fut.done() and not fut.cancelled():
+            fut.exception()
+
+# ========== SSE ==========
+
+def sse(event: str, data: Optional[dict] = None) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data or {}) + b"\n\n"
+
+# ========== Quart 路由 ==========
+
+@app.errorhandler(413)
+async def too_large(e):
+    return jsonify({"error": "Video too large"}), 413
+
+@app.errorhandler(408)
+async def upload_timeout(e):
+    return jsonify({"error": "Upload timed out"}), 408
 
 @app.route("/")
-def index():
-    return render_template("index.html")
+async def index():
+    return await render_template("index.html")
 
 @app.route("/analyze", methods=["POST"])
-def analyze_video():
-    api_key = request.form.get("api_key") or DEFAULT_API_KEY
+async def analyze_video():
+    # 解析表单前先按 Content-Length 拒绝超大请求, 避免白白落盘
+    if request.content_length and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"error": "Video too large"}), 413
+    form = await request.form
+    files = await request.files
+    api_key = form.get("api_key") or DEFAULT_API_KEY
     if not api_key: return jsonify({"error": "Missing API key"}), 400
-    if "video" not in request.files: return jsonify({"error": "No video file"}), 400
+    if "video" not in files: return jsonify({"error": "No video file"}), 400
     
-    persona = request.form.get("persona", "regular")
+    persona = form.get("persona", "regular")
+    # 未知 persona 统一按 regular 处理, 避免任意字符串各占一份缓存
+    if persona not in PERSONA_INSTRUCTIONS: persona = "regular"
 
-    file = request.files["video"]
+    file = files["video"]
     if file.filename == "": return jsonify({"error": "Empty filename"}), 400
+    if not (file.mimetype or "").startswith("video/"): return jsonify({"error": "Unsupported file type"}), 415
 
-    timestamp = int(time.time())
-    safe_name = file.filename.replace(" ", "_")
-    filename = f"vid_{timestamp}_{safe_name}"
-    save_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(save_path)
+    # 请求上下文结束前完成哈希和缓存查询, 之后 Quart 会关闭上传文件
+    key = cache_key(await asyncio.to_thread(stream_digest, file.stream), persona)
+    cached = await cache_get(key)
 
-    result = call_gemini_with_video(save_path, api_key, persona)
+    # 分析过程以 Server-Sent Events 推送: received -> upload -> processing* -> generating -> result/error
+    if cached is not None:
+        logger.info(f"Cache hit: {key}")
 
-    if "error" in result: return jsonify(result), 500
-    return jsonify(result)
+        async def event_stream():
+            yield sse("result", cached)
+    else:
+        # 接管上传文件流: 给 FileStorage 换一个空流, 请求结束时 Quart 只会关掉空流;
+        # 真正的流由后台任务用完后关闭
+        stream, file.stream = file.stream, io.BytesIO()
+        events = asyncio.Queue()
+
+        def notify(event: str, data: Optional[dict] = None):
+            events.put_nowait((event, data))
+
+        async def run():
+            result = None
+            try:
+                result = await analyze_once(key, stream, file.mimetype, api_key, persona, notify)
+            except Exception as e:
+                result = {"error": str(e)}
+            finally:
+                stream.close()
+                # 无论如何都发出最终事件, 否则 SSE 连接会一直挂着
+                if result is None:
+                    result = {"error": "Analysis was cancelled"}
+                notify("error" if "error" in result else "result", result)
+
+        # 客户端断开也让分析跑完, 结果照样进缓存 / 交给同一视频的其他请求
+        spawn_background(run())
+
+        async def event_stream():
+            yield sse("received")
+            while True:
+                event, data = await events.get()
+                yield sse(event, data)
+                if event in ("result", "error"):
+                    break
+
+    response = await make_response(event_stream(), {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    response.timeout = None
+    return response
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # 开发模式: QUART_DEV=1 python app.py (单进程 + 自动重载)
+    if os.environ.get("QUART_DEV"):
+        app.run(debug=True, port=5000)
+    else:
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = ["127.0.0.1:5000"]
+        asyncio.run(serve(app, config))